@@ -9,30 +9,43 @@ the stubs file will not be replaced.
 
 If this script is run with argument "--test", a file test_netCDF4.pyi will be output in
 the current directory rather than modifying the type stubs file.
+
+After merging, a stamp file is written to the user cache directory ($XDG_CACHE_HOME or
+~/.cache, under netcdf4-stubs/). If the docstrings, the stubs file, and this script are all
+unchanged since then, re-running the script does nothing.
+
+If orjson is installed, it is used to read and write docstrings JSON files.
 """
 
+import hashlib
 import json
-import shutil
+import os
 import sys
 import textwrap
 from pathlib import Path
 from types import ModuleType
-from typing import Dict, Union
+from typing import Any, Dict, Iterator, Sequence, Tuple, TypeVar, Union
 
 try:
     import libcst as cst
     import libcst._version
     import netCDF4
-    from libcst.metadata import MetadataWrapper, PositionProvider
 except ImportError:
     print("libcst and netCDF4 are required to run this script.", file=sys.stderr)
     sys.exit(1)
+try:
+    import orjson
+except ImportError:  # optional; fall back to the json module
+    orjson = None  # type: ignore[assignment]
 if libcst._version.__version_tuple__ < (1, 1, 0):
     print("libcst 1.1.0 or later is required", file=sys.stderr)
     sys.exit(1)
 
 STUBS_DIR = Path(__file__).resolve().parent / "netCDF4-stubs"
 
+_ModClsFunT = TypeVar("_ModClsFunT", cst.Module, cst.ClassDef, cst.FunctionDef)
+_ClsFunT = TypeVar("_ClsFunT", cst.ClassDef, cst.FunctionDef)
+
 
 def _is_from_module(obj, modname):
     """Check that a class, function, or descriptor is part of the netCDF4._netCDF4 module"""
@@ -43,37 +56,38 @@ def _is_from_module(obj, modname):
     return False
 
 
-def _add_docstring(docs_dict: Dict[str, str], module: ModuleType, membername: str, attrname: str = ""):
-    """If obj is a function, class, or descriptor, add its docstring to docs_dict with key obj_name"""
-    obj = getattr(getattr(module, membername), attrname) if attrname else getattr(module, membername)
-    if (
-        # functions, classes, descriptors
-        (callable(obj) or isinstance(obj, type) or hasattr(obj, "__get__"))
-        and _is_from_module(obj, module.__name__)
-        and (docstring := getattr(obj, "__doc__", ""))
-    ):
-        # strip trailing '.' if attrname is empty
-        key = ".".join([module.__name__, membername, attrname]).strip(".")
-        docs_dict[key] = docstring
+def _iter_members(module: ModuleType) -> Iterator[Tuple[str, Any]]:
+    """Yield (qualname, obj) for each top-level member of module and each attribute of its classes
+
+    Names are listed with dir() and resolved with getattr(), so module-level __dir__/__getattr__,
+    metaclass __dir__ overrides (e.g. Enum's), and descriptors all behave as they do at runtime.
+    """
+    for membername in dir(module):
+        member = getattr(module, membername)
+        yield membername, member
+        if isinstance(member, type):
+            for attrname in dir(member):
+                yield f"{membername}.{attrname}", getattr(member, attrname)
 
 
 def get_module_docstrings(module: ModuleType) -> Dict[str, str]:
     """Get dict of docstrings for top-level classes, their members, and functions"""
     docs_dict = {}
+    modname = module.__name__
     if mod_doc := getattr(module, "__doc__", ""):
-        docs_dict[module.__name__] = mod_doc
-    for membername in dir(module):
-        _add_docstring(docs_dict, module, membername)
-        member = getattr(module, membername)
-        if isinstance(member, type):
-            for attrname in dir(member):
-                _add_docstring(docs_dict, module, membername, attrname)
+        docs_dict[modname] = mod_doc
+    for qualname, obj in _iter_members(module):
+        if (
+            # functions, classes, descriptors
+            (callable(obj) or isinstance(obj, type) or hasattr(obj, "__get__"))
+            and _is_from_module(obj, modname)
+            and (docstring := getattr(obj, "__doc__", ""))
+        ):
+            docs_dict[f"{modname}.{qualname}"] = docstring
     return docs_dict
 
 
 class AddDocstrings(cst.CSTTransformer):
-    METADATA_DEPENDENCIES = (PositionProvider,)
-
     def __init__(self, module_name: str, docstrings: Dict[str, str], replace_existing=True):
         """Set up the transformer
 
@@ -90,33 +104,58 @@ class AddDocstrings(cst.CSTTransformer):
         """
         # stack for storing the canonical name of the current function
         self.stack: list[str] = [module_name]
+        # dotted prefixes of self.stack, so dotted_stack doesn't have to re-join it
+        self._dotted: list[str] = [module_name]
         self._module_name = module_name
         self._docstrings = docstrings
+        # every name appearing in a docstrings key; a def named otherwise can't contain a match
+        self._name_set = {part for key in docstrings for part in key.split(".")}
+        # last component of each docstrings key; only defs named one of these can get a docstring
+        self._leaf_names = {key.rsplit(".", 1)[-1] for key in docstrings}
         self.replace_existing = replace_existing
+        # docstring nodes by indented text; libcst nodes are immutable, so they can be shared
+        self._ds_cache: Dict[str, cst.SimpleStatementLine] = {}
 
     @property
     def dotted_stack(self) -> str:
         """e.g. module_name.MyClass.some_method"""
-        return ".".join(self.stack)
+        return self._dotted[-1]
 
     @property
     def body_indent(self) -> str:
         """The indent whitespace of a class or function body."""
         return " " * 4 * (len(self.stack) - 1)
 
-    def on_visit(self, node: cst.CSTNode) -> bool:
-        if isinstance(node, (cst.ClassDef, cst.FunctionDef)):
-            self.stack.append(node.name.value)
-        return super().on_visit(node)
+    def _enter_clsfun(self, node: Union[cst.ClassDef, cst.FunctionDef]) -> bool:
+        if node.name.value not in self._name_set:
+            return False  # skip the whole subtree; _leave_clsfun sees the same name and won't pop
+        self.stack.append(node.name.value)
+        self._dotted.append(f"{self._dotted[-1]}.{node.name.value}")
+        return True
+
+    def _leave_clsfun(self, node: _ClsFunT) -> _ClsFunT:
+        if node.name.value not in self._name_set:
+            return node
+        if node.name.value in self._leaf_names:
+            node = self._add_docstring_to_modclsfun(node)
+        self.stack.pop()
+        self._dotted.pop()
+        return node
+
+    def visit_ClassDef(self, node: cst.ClassDef) -> bool:
+        return self._enter_clsfun(node)
 
-    def on_leave(
-        self, original_node: cst.CSTNode, updated_node: cst.CSTNode
-    ) -> Union[cst.CSTNode, cst.RemovalSentinel, cst.FlattenSentinel]:
-        if isinstance(updated_node, (cst.Module, cst.ClassDef, cst.FunctionDef)):
-            retval = self._add_docstring_to_modclsfun(updated_node)
-            self.stack.pop()
-            return retval
-        return updated_node
+    def visit_FunctionDef(self, node: cst.FunctionDef) -> bool:
+        return self._enter_clsfun(node)
+
+    def leave_ClassDef(self, original_node: cst.ClassDef, updated_node: cst.ClassDef) -> cst.ClassDef:
+        return self._leave_clsfun(updated_node)
+
+    def leave_FunctionDef(self, original_node: cst.FunctionDef, updated_node: cst.FunctionDef) -> cst.FunctionDef:
+        return self._leave_clsfun(updated_node)
+
+    def leave_Module(self, original_node: cst.Module, updated_node: cst.Module) -> cst.Module:
+        return self._add_docstring_to_modclsfun(updated_node)
 
     def _indent_docstring(self, docstring: str) -> str:
         lines = docstring.strip().splitlines()
@@ -140,8 +179,8 @@ class AddDocstrings(cst.CSTTransformer):
 
     def _add_docstring_to_modclsfun(
         self,
-        node: Union[cst.Module, cst.ClassDef, cst.FunctionDef],
-    ) -> Union[cst.Module, cst.ClassDef, cst.FunctionDef]:
+        node: _ModClsFunT,
+    ) -> _ModClsFunT:
         """Add a docstring (if there is one) to a module, class, or function node.
 
         If there is an Ellipse for the class/function body it will be removed. If
@@ -161,50 +200,88 @@ class AddDocstrings(cst.CSTTransformer):
         node
             The updated node.
         """
-        if (self.has_docstring(node) and not self.replace_existing) or not (
-            docstring := self._docstrings.get(self.dotted_stack, "")
+        if not (docstring := self._docstrings.get(self.dotted_stack, "")):
+            return node
+        statements: Sequence[Any] = node.body if isinstance(node, cst.Module) else node.body.body
+        # Keep an existing docstring unless replacing. libcst node classes aren't subclassed,
+        # so compare classes directly rather than going through isinstance.
+        if (
+            not self.replace_existing
+            and statements
+            and (first := statements[0]).__class__ is cst.SimpleStatementLine
+            and (expr := first.body[0]).__class__ is cst.Expr
+            and expr.value.__class__ is cst.SimpleString
         ):
             return node
         docstring = self._indent_docstring(docstring)
-        docstring_node = cst.SimpleStatementLine(body=[cst.Expr(cst.SimpleString(f'"""{docstring}"""'))])
+        if (docstring_node := self._ds_cache.get(docstring)) is None:
+            docstring_node = cst.SimpleStatementLine(body=[cst.Expr(cst.SimpleString(f'"""{docstring}"""'))])
+            self._ds_cache[docstring] = docstring_node
         # If the first statement is an ellipsis or a docstring, replace it in the series of
         # statements. Otherwise, prepend to the statements.
-        statements = node.body if isinstance(node, cst.Module) else node.body.body
         if self.is_ellipsis_node(statements[0]) or (self.is_docstring_node(statements[0]) and self.replace_existing):
-            new_statement_body = [docstring_node, *statements[1:]]
+            new_statement_body = (docstring_node, *statements[1:])
         else:
-            new_statement_body = [docstring_node, *statements]
+            new_statement_body = (docstring_node, *statements)
         # If it's a Module, there's no wrapper around the statements so we just update
         # the module with the new statements and return that.
         if isinstance(node, cst.Module):
             return node.with_changes(body=new_statement_body)
         # If the class/function body is on the same line as the parameters
         # (SimpleStatementSuite), replace it with an IndentedBlock.
+        statements_wrapper: cst.BaseSuite
         if isinstance(node.body, cst.SimpleStatementSuite):
             statements_wrapper = cst.IndentedBlock(body=new_statement_body)
         else:
             statements_wrapper = node.body.with_changes(body=new_statement_body)
         return node.with_changes(body=statements_wrapper)
 
-    def has_docstring(self, node: Union[cst.Module, cst.ClassDef, cst.FunctionDef]):
-        statements = node.body.body if isinstance(node.body, cst.BaseSuite) else node.body
-        if not statements:
-            return False
-        first_statement = statements[0]
-        if isinstance(first_statement, cst.SimpleStatementLine) and isinstance(first_statement.body[0], cst.Expr):
-            expr = first_statement.body[0].value
-            if isinstance(expr, cst.SimpleString):
-                return True
-        return False
-
 
-def add_docstrings(docstrings: Dict[str, str], module_name: str, pyi_file, replace_existing=True):
-    """Add docstrings to a type stub file"""
+def add_docstrings(docstrings: Dict[str, str], module_name: str, pyi_file, replace_existing=True, outfile=None):
+    """Add docstrings to a type stub file, writing the result to outfile (default: pyi_file)"""
     tree = cst.parse_module(Path(pyi_file).read_text())
-    wrapper = MetadataWrapper(tree)
     transformer = AddDocstrings(module_name, docstrings, replace_existing)
-    modified_tree = wrapper.visit(transformer)
-    Path(pyi_file).write_text(modified_tree.code)
+    modified_tree = tree.visit(transformer)
+    Path(outfile or pyi_file).write_text(modified_tree.code)
+
+
+def _dumps_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent="  ", ensure_ascii=False).encode()
+
+
+def _loads_json(data: bytes):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def docstrings_hash(docstrings: Dict[str, str]) -> str:
+    """Hash of the docstrings content, independent of key order"""
+    return hashlib.sha1(json.dumps(docstrings, sort_keys=True).encode()).hexdigest()
+
+
+def _stamp_path(pyi_file: Path) -> Path:
+    """Location of the merge stamp for pyi_file, kept outside the (possibly installed) package"""
+    cache_dir = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "netcdf4-stubs"
+    return cache_dir / f"{hashlib.sha1(str(pyi_file).encode()).hexdigest()}.stamp"
+
+
+def _read_stamp(pyi_file: Path) -> str:
+    """Contents of the merge stamp for pyi_file, or "" if there is none or it can't be read"""
+    try:
+        return _stamp_path(pyi_file).read_text()
+    except (OSError, RuntimeError):  # RuntimeError: no home directory
+        return ""
+
+
+def _write_stamp(pyi_file: Path, stamp: str):
+    """Write the merge stamp for pyi_file; it is only a cache, so failures are ignored"""
+    try:
+        stamp_file = _stamp_path(pyi_file)
+        stamp_file.parent.mkdir(parents=True, exist_ok=True)
+        stamp_file.write_text(stamp)
+    except (OSError, RuntimeError):
+        pass
 
 
 def get_and_save_doctrings():
@@ -213,25 +290,28 @@ def get_and_save_doctrings():
     docstrings_path = (
         Path(__file__).parent / "docstrings" / f"netCDF4._netCDF4.{netCDF4.__version__}_docstrings.json"  # type: ignore
     )
-    with open(docstrings_path, "w") as fobj:
-        json.dump(pyx_docstrings, fobj, indent="  ")
+    docstrings_path.write_bytes(_dumps_json(pyx_docstrings))
 
 
 def load_docstrings(netCDF4_version: str) -> Dict[str, str]:
     """Load docstrings from JSON"""
     docstrings_path = Path(__file__).parent / "docstrings" / f"netCDF4._netCDF4.{netCDF4_version}_docstrings.json"
-    with open(docstrings_path, "r") as fobj:
-        return json.load(fobj)
+    return _loads_json(docstrings_path.read_bytes())
 
 
 def merge_docstrings(test=True, replace_existing=True):
     pyx_docstrings = get_module_docstrings(netCDF4._netCDF4)
     pyi_file = STUBS_DIR / "_netCDF4.pyi"
     if test:
-        outfile = "test_netCDF4.pyi"
-        shutil.copyfile(pyi_file, outfile)
-        pyi_file = outfile
+        add_docstrings(pyx_docstrings, "netCDF4._netCDF4", pyi_file, replace_existing, outfile="test_netCDF4.pyi")
+        return
+    # Skip the parse/transform/write entirely if this exact merge was already done.
+    script_hash = hashlib.sha1(Path(__file__).read_bytes()).hexdigest()
+    merge_id = f"{docstrings_hash(pyx_docstrings)} {script_hash} replace_existing={replace_existing}"
+    if _read_stamp(pyi_file) == f"{merge_id} {pyi_file.stat().st_mtime_ns}":
+        return
     add_docstrings(pyx_docstrings, "netCDF4._netCDF4", pyi_file, replace_existing)
+    _write_stamp(pyi_file, f"{merge_id} {pyi_file.stat().st_mtime_ns}")
 
 
 def cli():